@@ -1,49 +1,253 @@
 import os
 import json
-import time
-from typing import Optional, Dict, Any
-from fastapi import FastAPI, HTTPException
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from pydantic import ValidationError
-import requests
+import httpx
+from cachetools import TTLCache
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from jinja2 import Environment, FileSystemLoader
 
 from database import db
 from schemas import EvaluationRequest, Evaluation
 
-app = FastAPI(title="Agent Evaluator API")
+# Keep idle connections around long enough to be reused across requests
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=30)
+# Upper bound on any single fetched body; larger responses are rejected mid-stream
+MAX_FETCH_BYTES = int(os.getenv("MAX_FETCH_BYTES", 10 * 1024 * 1024))
+# Evaluations older than this are expired by MongoDB's TTL monitor
+EVALUATION_TTL_SECONDS = int(os.getenv("EVALUATION_TTL_DAYS", 30)) * 24 * 60 * 60
+# Comma-separated browser origins allowed by CORS; defaults to any origin
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+# Caps in-flight outbound requests across all evaluations; held per attempt, not across backoff
+HTTP_MAX_CONCURRENCY = int(os.getenv("HTTP_MAX_CONCURRENCY", 50))
+# Recently fetched URLs -> body length, so repeat evaluations skip the download
+_FETCH_LEN_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=int(os.getenv("FETCH_CACHE_TTL", 300)))
+# /test is polled by health checks; only hit Mongo for the collection list every few seconds
+_COLLECTIONS_CACHE: TTLCache = TTLCache(maxsize=1, ttl=5)
+# Environment is fixed for the life of the process (database.py has already loaded .env)
+DATABASE_URL_SET = bool(os.getenv("DATABASE_URL"))
+DATABASE_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+
+logger = logging.getLogger(__name__)
+
+# Report template is compiled once at import and reused for every render
+TEMPLATE_ENV = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")),
+    auto_reload=False,
+    autoescape=True,
+)
+REPORT_TPL = TEMPLATE_ENV.get_template("report.html")
+
+
+class EvaluationWriter:
+    """
+    Buffers final evaluation updates and flushes them with one bulk_write.
+    A batch is written once it reaches max_batch updates or max_delay seconds
+    after its first update, whichever comes first. Failed batches are retried
+    with backoff; updates submitted while the writer isn't running (before
+    start, after stop, or after the flusher died) are written directly.
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        max_delay: float = 0.05,
+        max_batch: int = 100,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.collection_name = collection_name
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._buffer: List[Tuple[ObjectId, Dict[str, Any]]] = []
+        self._has_items: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        # Events bind to the running loop, so build them per start rather than at import
+        self._buffer = []
+        self._has_items = asyncio.Event()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_task_done)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        # Let the flusher finish any in-progress write and drain the buffer rather than cancelling it
+        self._stopping = True
+        self._has_items.set()
+        self._full.set()
+        try:
+            await self._task
+        except Exception:
+            # Already logged by _on_task_done; still write whatever it left behind
+            pass
+        self._task = None
+        if self._buffer:
+            await self._flush()
+
+    async def submit(self, eval_id: ObjectId, fields: Dict[str, Any]) -> None:
+        if self._task is None or self._task.done() or self._stopping:
+            # Nothing will flush the buffer, so write it out together with this update
+            batch, self._buffer = self._buffer + [(eval_id, fields)], []
+            await self._write(batch)
+            return
+        self._buffer.append((eval_id, fields))
+        self._has_items.set()
+        if len(self._buffer) >= self.max_batch:
+            self._full.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_items.wait()
+            if not self._stopping:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+            if self._stopping and not self._buffer:
+                return
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            logger.error("Evaluation writer flusher crashed; writing updates directly", exc_info=exc)
+
+    async def _flush(self) -> None:
+        batch, self._buffer = self._buffer, []
+        self._has_items.clear()
+        self._full.clear()
+        if batch:
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[ObjectId, Dict[str, Any]]]) -> None:
+        ops = [UpdateOne({"_id": eval_id}, {"$set": fields}) for eval_id, fields in batch]
+        # $set updates are idempotent, so re-sending a partially applied batch is safe
+        for attempt in range(self.max_retries):
+            try:
+                await db[self.collection_name].bulk_write(ops, ordered=False)
+                return
+            except Exception:
+                if attempt == self.max_retries - 1:
+                    logger.exception(
+                        "Failed to write %d evaluation updates after %d attempts: %s",
+                        len(batch),
+                        self.max_retries,
+                        [str(eval_id) for eval_id, _ in batch],
+                    )
+                    return
+                logger.warning("Evaluation bulk write failed, retrying", exc_info=True)
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+
+
+EVAL_WRITER = EvaluationWriter("evaluation")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared client so outbound fetches reuse pooled keep-alive connections
+    app.state.http = httpx.AsyncClient(timeout=10, limits=HTTP_LIMITS)
+    # Built per startup so it binds to the loop that is actually serving requests
+    app.state.http_sem = asyncio.Semaphore(HTTP_MAX_CONCURRENCY)
+    # Report rendering is CPU work; run it here so the event loop stays free for I/O
+    app.state.render_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="report")
+    if db is not None:
+        try:
+            await db["evaluation"].create_index("status")
+            await db["evaluation"].create_index("created_at", expireAfterSeconds=EVALUATION_TTL_SECONDS)
+        except Exception as e:
+            # Don't refuse to start over indexes; /test reports connectivity problems
+            logger.warning("Could not ensure evaluation indexes: %s", e)
+        EVAL_WRITER.start()
+    try:
+        yield
+    finally:
+        if db is not None:
+            await EVAL_WRITER.stop()
+        await app.state.http.aclose()
+        app.state.render_pool.shutdown(wait=False)
+
+
+app = FastAPI(title="Agent Evaluator API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 
-def fetch_with_retries(url: str, max_retries: int = 3, backoff: float = 0.8, timeout: int = 10) -> str:
+async def _fetch(client: httpx.AsyncClient, sem: asyncio.Semaphore, url: str, max_retries: int = 3, backoff: float = 0.8, timeout: int = 10) -> str:
     last_err: Optional[Exception] = None
     for attempt in range(max_retries):
         try:
-            resp = requests.get(url, timeout=timeout)
-            resp.raise_for_status()
-            return resp.text
+            async with sem, client.stream("GET", url, timeout=timeout) as resp:
+                resp.raise_for_status()
+                declared = resp.headers.get("content-length")
+                if declared and declared.isdigit() and int(declared) > MAX_FETCH_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Response from {url} exceeds {MAX_FETCH_BYTES} bytes")
+                total = 0
+                chunks = []
+                async for chunk in resp.aiter_bytes(65536):
+                    total += len(chunk)
+                    if total > MAX_FETCH_BYTES:
+                        raise HTTPException(status_code=413, detail=f"Response from {url} exceeds {MAX_FETCH_BYTES} bytes")
+                    chunks.append(chunk)
+                return b"".join(chunks).decode(resp.encoding or "utf-8", errors="replace")
+        except HTTPException:
+            # Oversized bodies won't shrink on retry
+            raise
         except Exception as e:
             last_err = e
             if attempt < max_retries - 1:
-                time.sleep(backoff * (2 ** attempt))
+                await asyncio.sleep(backoff * (2 ** attempt))
     raise HTTPException(status_code=502, detail=f"Failed to fetch {url}: {str(last_err)}")
 
 
-def dummy_deepeval(agent_card: str, chat_logs: Optional[str]) -> Dict[str, Any]:
+async def _fetch_len(client: httpx.AsyncClient, sem: asyncio.Semaphore, url: str) -> int:
+    # Scoring only depends on body length, so cache that instead of the body itself
+    cached = _FETCH_LEN_CACHE.get(url)
+    if cached is not None:
+        return cached
+    length = len(await _fetch(client, sem, url))
+    _FETCH_LEN_CACHE[url] = length
+    return length
+
+
+async def _noop() -> None:
+    return None
+
+
+def dummy_deepeval(card_len: int, chat_len: int) -> Dict[str, Any]:
     """
     A lightweight, deterministic mock for deepeval.evaluate().
-    It derives pseudo-scores from content lengths to keep things testable and reproducible.
+    It derives pseudo-scores from content lengths to keep things testable and reproducible,
+    so only the lengths are passed in and the fetched bodies can be released early.
     """
-    base = max(1, len(agent_card))
-    chat_factor = (len(chat_logs) if chat_logs else 0) % 1000
+    base = max(1, card_len)
+    chat_factor = chat_len % 1000
 
     def norm(v: float) -> float:
         return round(max(0.0, min(1.0, v)), 2)
@@ -70,63 +274,26 @@ def dummy_deepeval(agent_card: str, chat_logs: Optional[str]) -> Dict[str, Any]:
 
 
 def render_html_report(evaluation: Dict[str, Any]) -> str:
-    m = evaluation.get("metrics", {})
-    def row(label: str, value: Any) -> str:
-        return f"<tr><td style='padding:8px;font-weight:600'>{label}</td><td style='padding:8px'>{value}</td></tr>"
-
-    safety = m.get("safety", {})
-    mcp = m.get("mcp_compliance", {})
-    bot = m.get("chatbot", {})
-
-    html = f"""
-    <html>
-      <head>
-        <meta charset='utf-8' />
-        <meta name='viewport' content='width=device-width, initial-scale=1' />
-        <title>Agent Evaluator Report</title>
-        <style>
-          body {{ font-family: ui-sans-serif, system-ui, -apple-system; padding: 24px; background: #0b1020; color: #e6f0ff; }}
-          .card {{ background: #0f172a; border: 1px solid #1f2a44; border-radius: 12px; padding: 20px; max-width: 960px; margin: 0 auto; }}
-          h1 {{ font-size: 24px; margin: 0 0 12px; }}
-          h2 {{ font-size: 18px; margin: 20px 0 8px; color: #9fb3ff; }}
-          table {{ width: 100%; border-collapse: collapse; margin-top: 8px; }}
-          tr:nth-child(even) td {{ background: #0b132b; }}
-          td {{ border-top: 1px solid #1f2a44; }}
-          .muted {{ color: #9fb3ff; }}
-        </style>
-      </head>
-      <body>
-        <div class='card'>
-          <h1>Agent Evaluator Report</h1>
-          <div class='muted'>Status: {evaluation.get('status')}</div>
-          <div class='muted'>Agent Card: {evaluation.get('agent_card_url')}</div>
-          <div class='muted'>Chat Logs: {evaluation.get('chat_url') or '—'}</div>
-
-          <h2>MCP Compliance</h2>
-          <table>
-            {row('Spec Alignment', mcp.get('spec_alignment', 'n/a'))}
-            {row('Tools Schema Valid', mcp.get('tools_schema_valid', 'n/a'))}
-          </table>
-
-          <h2>Safety</h2>
-          <table>
-            {row('Toxicity', safety.get('toxicity', 'n/a'))}
-            {row('Compliance', safety.get('compliance', 'n/a'))}
-            {row('Harmfulness', safety.get('harmfulness', 'n/a'))}
-          </table>
-
-          <h2>Chatbot Metrics</h2>
-          <table>
-            {row('Relevance', bot.get('relevance', 'n/a'))}
-            {row('Helpfulness', bot.get('helpfulness', 'n/a'))}
-            {row('Factuality', bot.get('factuality', 'n/a'))}
-            {row('Latency (ms)', bot.get('latency', 'n/a'))}
-          </table>
-        </div>
-      </body>
-    </html>
-    """
-    return html
+    m = evaluation.get("metrics") or {}
+    return REPORT_TPL.render(
+        ev=evaluation,
+        mcp=m.get("mcp_compliance", {}),
+        safety=m.get("safety", {}),
+        bot=m.get("chatbot", {}),
+    )
+
+
+def require_db():
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not configured")
+    return db
+
+
+def eval_oid(evaluation_id: str) -> ObjectId:
+    try:
+        return ObjectId(evaluation_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid evaluation id")
 
 
 @app.get("/")
@@ -134,61 +301,46 @@ def read_root():
     return {"message": "Agent Evaluator API"}
 
 
-@app.post("/evaluate")
-def evaluate(req: EvaluationRequest):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
+async def _run_eval(eval_id: ObjectId, req: EvaluationRequest, client: httpx.AsyncClient, sem: asyncio.Semaphore) -> None:
+    """Fetch, score and persist an evaluation; failures are recorded on the document."""
+    try:
+        card_len, chat_len = await asyncio.gather(
+            _fetch_len(client, sem, str(req.agent_card_url)),
+            _fetch_len(client, sem, str(req.chat_url)) if req.chat_url else _noop(),
+        )
+
+        metrics = dummy_deepeval(card_len, chat_len or 0)
+        # HTML is rendered on demand by /evaluations/{id}/report
+        final: Dict[str, Any] = {"status": "completed", "metrics": metrics}
+    except HTTPException as e:
+        # No caller is waiting on the response, so keep the fetch error on the record
+        final = {"status": "failed", "error": str(e.detail)}
+    except Exception as e:
+        final = {"status": "failed", "error": str(e)}
+
+    # Single write per evaluation once the outcome is known, batched with its neighbours
+    await EVAL_WRITER.submit(eval_id, final)
 
-    # Create initial record
+
+@app.post("/evaluate", status_code=202)
+async def evaluate(req: EvaluationRequest, request: Request, background_tasks: BackgroundTasks, _db=Depends(require_db)):
+    # Create initial record; clients poll /evaluations/{id} for the outcome
     doc = Evaluation(
         agent_card_url=str(req.agent_card_url),
         chat_url=str(req.chat_url) if req.chat_url else None,
         status="running",
     ).model_dump()
-    inserted = db["evaluation"].insert_one(doc)
-    eval_id = str(inserted.inserted_id)
+    inserted = await db["evaluation"].insert_one(doc)
 
-    try:
-        agent_card_text = fetch_with_retries(str(req.agent_card_url))
-        chat_text = fetch_with_retries(str(req.chat_url)) if req.chat_url else None
-
-        metrics = dummy_deepeval(agent_card_text, chat_text)
-
-        updated = {
-            "status": "completed",
-            "metrics": metrics,
-        }
-        # Render HTML after metrics populated
-        temp_doc = {**doc, **updated}
-        temp_doc["metrics"] = metrics
-        temp_doc["status"] = "completed"
-        temp_doc["agent_card_url"] = str(req.agent_card_url)
-        temp_doc["chat_url"] = str(req.chat_url) if req.chat_url else None
-        html = render_html_report(temp_doc)
-        updated["html_report"] = html
-
-        db["evaluation"].update_one({"_id": inserted.inserted_id}, {"$set": updated})
-
-        return {"id": eval_id, "status": "completed", "metrics": metrics}
-    except HTTPException:
-        # Pass through HTTPExceptions as failure state
-        db["evaluation"].update_one({"_id": inserted.inserted_id}, {"$set": {"status": "failed"}})
-        raise
-    except Exception as e:
-        db["evaluation"].update_one({"_id": inserted.inserted_id}, {"$set": {"status": "failed", "error": str(e)}})
-        raise HTTPException(status_code=500, detail=f"Evaluation failed: {str(e)}")
+    background_tasks.add_task(_run_eval, inserted.inserted_id, req, request.app.state.http, request.app.state.http_sem)
+    return {"id": str(inserted.inserted_id), "status": "running"}
 
 
 @app.get("/evaluations/{evaluation_id}")
-def get_evaluation(evaluation_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        _id = ObjectId(evaluation_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid evaluation id")
-
-    doc = db["evaluation"].find_one({"_id": _id})
+async def get_evaluation(include_html: bool = False, _db=Depends(require_db), _id: ObjectId = Depends(eval_oid)):
+    # The cached report can be large; leave it out unless explicitly requested
+    projection = None if include_html else {"html_report": 0}
+    doc = await db["evaluation"].find_one({"_id": _id}, projection=projection)
     if not doc:
         raise HTTPException(status_code=404, detail="Evaluation not found")
     doc["id"] = str(doc.pop("_id"))
@@ -196,31 +348,39 @@ def get_evaluation(evaluation_id: str):
 
 
 @app.get("/evaluations/{evaluation_id}/report", response_class=HTMLResponse)
-def get_evaluation_report(evaluation_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not configured")
-    try:
-        _id = ObjectId(evaluation_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid evaluation id")
-
-    doc = db["evaluation"].find_one({"_id": _id})
+async def get_evaluation_report(request: Request, _db=Depends(require_db), _id: ObjectId = Depends(eval_oid)):
+    etag = f'W/"{_id}-completed"'
+    if request.headers.get("if-none-match") == etag:
+        # Revalidate against a status-only read; the record may have expired or never existed
+        head = await db["evaluation"].find_one({"_id": _id}, projection={"status": 1})
+        if not head:
+            raise HTTPException(status_code=404, detail="Evaluation not found")
+        if head.get("status") == "completed":
+            return Response(status_code=304, headers={"ETag": etag})
+
+    doc = await db["evaluation"].find_one({"_id": _id})
     if not doc:
         raise HTTPException(status_code=404, detail="Evaluation not found")
     html = doc.get("html_report")
     if not html:
         # If no pre-rendered HTML, render from stored metrics if available
-        html = render_html_report({
+        html = await asyncio.get_running_loop().run_in_executor(request.app.state.render_pool, render_html_report, {
             "status": doc.get("status"),
             "agent_card_url": doc.get("agent_card_url"),
             "chat_url": doc.get("chat_url"),
             "metrics": doc.get("metrics") or {},
         })
-    return HTMLResponse(content=html, status_code=200)
+        # Cache the first render once the evaluation has settled
+        if doc.get("status") == "completed":
+            await db["evaluation"].update_one({"_id": _id}, {"$set": {"html_report": html}})
+    headers = None
+    if doc.get("status") == "completed":
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=86400, immutable"}
+    return HTMLResponse(content=html, status_code=200, headers=headers)
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -237,7 +397,10 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = _COLLECTIONS_CACHE.get("names")
+                if collections is None:
+                    collections = await db.list_collection_names()
+                    _COLLECTIONS_CACHE["names"] = collections
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -247,8 +410,8 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if DATABASE_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if DATABASE_NAME_SET else "❌ Not Set"
 
     return response
 
@@ -256,4 +419,6 @@ def test_database():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # Multiple workers require an import string rather than the app object
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)
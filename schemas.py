@@ -13,6 +13,7 @@ Model name is converted to lowercase for the collection name:
 
 from pydantic import BaseModel, Field, HttpUrl
 from typing import Optional, Dict, Any
+from datetime import datetime, timezone
 
 # Example schemas (you can keep these as samples):
 
@@ -55,3 +56,4 @@ class Evaluation(BaseModel):
     metrics: Optional[Dict[str, Any]] = Field(None, description="Structured JSON metrics output")
     html_report: Optional[str] = Field(None, description="Pre-rendered HTML report")
     error: Optional[str] = Field(None, description="Error message if failed")
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="Creation time; drives the TTL index")
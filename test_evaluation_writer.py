@@ -0,0 +1,142 @@
+"""
+Tests for EvaluationWriter's batching, retry and shutdown behaviour.
+
+Run with: python -m pytest -q
+"""
+
+import asyncio
+
+import pytest
+
+import main
+from main import EvaluationWriter
+
+
+class FakeCollection:
+    """Stands in for a Motor collection; records the size of every bulk_write batch."""
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.failures = failures
+        self.delay = delay
+        self.batches = []
+        self.attempts = 0
+
+    async def bulk_write(self, ops, ordered=True):
+        self.attempts += 1
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("write failed")
+        self.batches.append(len(ops))
+
+    @property
+    def written(self) -> int:
+        return sum(self.batches)
+
+
+@pytest.fixture
+def coll(monkeypatch):
+    fake = FakeCollection()
+    monkeypatch.setattr(main, "db", {"evaluation": fake})
+    return fake
+
+
+def test_flushes_after_max_delay(coll):
+    async def scenario():
+        writer = EvaluationWriter("evaluation", max_delay=0.02)
+        writer.start()
+        await writer.submit("a", {"status": "completed"})
+        await writer.submit("b", {"status": "completed"})
+        assert coll.batches == []
+        await asyncio.sleep(0.1)
+        assert coll.batches == [2]
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_flushes_when_batch_is_full(coll):
+    async def scenario():
+        writer = EvaluationWriter("evaluation", max_delay=10, max_batch=3)
+        writer.start()
+        for i in range(3):
+            await writer.submit(str(i), {"status": "completed"})
+        await asyncio.sleep(0.05)
+        assert coll.batches == [3]
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_retries_failed_batch(coll):
+    coll.failures = 2
+
+    async def scenario():
+        writer = EvaluationWriter("evaluation", max_delay=0.01, backoff=0.001)
+        writer.start()
+        await writer.submit("a", {"status": "completed"})
+        await asyncio.sleep(0.1)
+        assert coll.attempts == 3
+        assert coll.batches == [1]
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stop_drains_in_flight_and_buffered_updates(coll):
+    coll.delay = 0.1
+
+    async def scenario():
+        writer = EvaluationWriter("evaluation", max_delay=0.01)
+        writer.start()
+        for i in range(3):
+            await writer.submit(str(i), {"status": "completed"})
+        await asyncio.sleep(0.05)  # flusher is now inside bulk_write
+        await writer.submit("pending", {"status": "completed"})
+        await writer.stop()
+        assert coll.written == 4
+
+    asyncio.run(scenario())
+
+
+def test_writes_directly_when_not_running(coll):
+    async def scenario():
+        writer = EvaluationWriter("evaluation")
+        await writer.submit("before-start", {"status": "completed"})
+        writer.start()
+        await writer.stop()
+        await writer.submit("after-stop", {"status": "completed"})
+        assert coll.batches == [1, 1]
+
+    asyncio.run(scenario())
+
+
+def test_restarts_on_a_new_event_loop(coll):
+    writer = EvaluationWriter("evaluation", max_delay=0.01)
+
+    async def scenario():
+        writer.start()
+        await writer.submit("a", {"status": "completed"})
+        await asyncio.sleep(0.05)
+        await writer.stop()
+
+    asyncio.run(scenario())
+    asyncio.run(scenario())
+    assert coll.batches == [1, 1]
+
+
+def test_writes_directly_after_flusher_crash(coll, caplog):
+    async def crash():
+        raise RuntimeError("flusher died")
+
+    async def scenario():
+        writer = EvaluationWriter("evaluation", max_delay=10)
+        writer._run = crash
+        writer.start()
+        await asyncio.sleep(0)
+        await writer.submit("a", {"status": "completed"})
+        assert coll.batches == [1]
+        await writer.stop()
+
+    asyncio.run(scenario())
+    assert "flusher crashed" in caplog.text